@@ -17,7 +17,7 @@ import fiftyone.utils.data as foud
 import fiftyone.core.metadata as fom
 import fiftyone.core.labels as fol
 
-from core.utils import get_all_file_path, parse_xml_info, parse_img_metadata, normalization_xyxy, md5sum
+from core.utils import get_all_file_path, parse_xml_info, parse_img_metadata, normalization_xyxy, md5sum, xxhash_sum
 from core.logging import logging
 
 
@@ -182,6 +182,9 @@ def generate_sgcc_sample(img_path,
 
     xml_path = os.path.splitext(img_path)[0] + ".xml"
     if os.path.exists(xml_path):
-        sample["xml_md5"] = md5sum(xml_path)
+        xml_stat = os.stat(xml_path)
+        sample["xml_hash"] = xxhash_sum(xml_path)
+        sample["xml_mtime"] = xml_stat.st_mtime_ns
+        sample["xml_size"] = xml_stat.st_size
 
     return sample
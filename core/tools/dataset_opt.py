@@ -8,11 +8,12 @@
 @Description:
 """
 
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Tuple, Dict
 from pprint import pprint
 from datetime import datetime
 
 import os
+import time
 import json
 from concurrent import futures
 
@@ -20,7 +21,7 @@ import fiftyone as fo
 import fiftyone.core.dataset as focd
 from tqdm import tqdm
 
-from core.utils import get_sample_field, md5sum, get_all_file_path
+from core.utils import get_sample_field, md5sum, xxhash_sum, get_all_file_path
 from core.exporter.sgccgame_dataset_exporter import SGCCGameDatasetExporter
 from core.logging import logging
 
@@ -28,6 +29,138 @@ from core.cache import WEAK_CACHE
 from core.importer import parse_sample_info, generate_sgcc_sample
 from .common_tools import imgslist2dataview
 
+# 记录 last_update_ns 时往前留的余量.文件的ctime来自文件系统时钟(粗粒度,NFS/NAS上还是服务端时钟),
+# 可能落后于本机 time.time_ns(),不留余量的话刚好在更新后拷入的文件会被永远漏掉
+_SCAN_SAFETY_MARGIN_NS = 10 * 60 * 10**9
+
+
+def _collect_xml_changes(
+    dataset, imgs_set: Optional[set] = None
+) -> Tuple[List[str], Dict[str, Optional[dict]], Dict[str, dict]]:
+    """找出xml可能发生变化的样本,并用多进程计算这些xml的hash
+
+    Args:
+        dataset: 待检查的数据集
+        imgs_set (Optional[set]): 若不为None,只检查filepath在其中的样本
+
+    Returns:
+        Tuple[List[str], Dict[str, Optional[dict]], Dict[str, dict]]:
+            数据集中所有样本的filepath;
+            需要逐个样本更新的 filepath 到 xml信息(xml_hash,xml_mtime,xml_size)的映射,
+            xml不存在的样本映射为None;
+            xml内容没变,只需要刷新 xml_mtime,xml_size 的样本的同样映射
+    """
+    schema = dataset.get_field_schema()
+    fields = [f for f in ("xml_hash", "xml_mtime", "xml_size") if f in schema]
+    filepaths, *cols = dataset.values(["filepath"] + fields)
+    cols = dict(zip(fields, cols))
+    empty_col = [None] * len(filepaths)
+    # 数据集从未记录过xml hash时,只处理xml被删除的情况
+    has_hash_field = "xml_hash" in schema or "xml_md5" in schema
+
+    xml_infos = {}
+    stat_infos = {}
+    need_hash = {}
+    # 热循环中用局部变量代替全局/属性查找
+    _splitext = os.path.splitext
+    _stat = os.stat
+    xml_paths = [_splitext(p)[0] + ".xml" for p in filepaths]
+    for filepath, xml_path, old_hash, xml_mtime, xml_size in zip(
+        filepaths,
+        xml_paths,
+        cols.get("xml_hash", empty_col),
+        cols.get("xml_mtime", empty_col),
+        cols.get("xml_size", empty_col),
+    ):
+        if imgs_set is not None and filepath not in imgs_set:
+            continue
+        try:
+            xml_stat = _stat(xml_path)
+        except FileNotFoundError:
+            xml_infos[filepath] = None
+            continue
+        if not has_hash_field:
+            continue
+        # mtime 和文件大小都没变就认为xml没变,省掉计算hash
+        if xml_mtime == xml_stat.st_mtime_ns and xml_size == xml_stat.st_size:
+            continue
+        need_hash[filepath] = (xml_path, xml_stat, old_hash)
+
+    if need_hash:
+        with futures.ProcessPoolExecutor() as pe:
+            hashes = pe.map(
+                xxhash_sum, [v[0] for v in need_hash.values()], chunksize=64
+            )
+            for (filepath, (_, xml_stat, old_hash)), xml_hash in tqdm(
+                zip(need_hash.items(), hashes),
+                total=len(need_hash),
+                desc="xml校验进度:",
+                dynamic_ncols=True,
+                colour="green",
+            ):
+                xml_info = {
+                    "xml_hash": xml_hash,
+                    "xml_mtime": xml_stat.st_mtime_ns,
+                    "xml_size": xml_stat.st_size,
+                }
+                # 没有 xml_hash 的旧样本仍需逐个处理(迁移md5或重新解析)
+                if old_hash is not None and old_hash == xml_hash:
+                    stat_infos[filepath] = xml_info
+                else:
+                    xml_infos[filepath] = xml_info
+    return filepaths, xml_infos, stat_infos
+
+
+def _update_sample_by_xml(sample, xml_info: Optional[dict]) -> bool:
+    """根据 ``_collect_xml_changes`` 得到的xml信息更新样本,需要在 autosave 的迭代中调用
+
+    Returns:
+        bool: 样本标签是否因xml变化而被更新
+    """
+    if xml_info is None:
+        sample.clear_field("ground_truth")
+        return False
+    old_hash = get_sample_field(sample, "xml_hash")
+    if old_hash is None and sample.has_field("xml_md5"):
+        # 旧数据集只记录了 xml_md5,用md5比对一次,之后迁移到 xml_hash
+        xml_path = os.path.splitext(sample.filepath)[0] + ".xml"
+        xml_changed = sample.get_field("xml_md5") != md5sum(xml_path)
+    else:
+        xml_changed = old_hash != xml_info["xml_hash"]
+    if xml_changed:
+        img_meta, label_info, anno_dict = parse_sample_info(sample.filepath)
+        sample.update_fields(anno_dict)
+        sample.update_fields(
+            {"metadata": img_meta, "ground_truth": label_info, **xml_info}
+        )
+        return True
+    sample.update_fields(xml_info)
+    return False
+
+
+def _apply_xml_changes(
+    dataset, xml_infos: Dict[str, Optional[dict]], stat_infos: Dict[str, dict]
+) -> List[str]:
+    """把 ``_collect_xml_changes`` 的结果写回数据集,返回标签被更新的样本filepath"""
+    # 内容没变的xml只刷新stat字段,直接批量写入,不用取出样本
+    if stat_infos:
+        for field in ("xml_mtime", "xml_size"):
+            dataset.set_values(
+                field,
+                {k: v[field] for k, v in stat_infos.items()},
+                key_field="filepath",
+            )
+
+    update_img_path_list = []
+    if not xml_infos:
+        return update_img_path_list
+    for sample in dataset.select_by("filepath", list(xml_infos)).iter_samples(
+        progress=True, autosave=True, batch_size=0.2
+    ):
+        if _update_sample_by_xml(sample, xml_infos[sample.filepath]):
+            update_img_path_list.append(sample.filepath)
+    return update_img_path_list
+
 
 def update_dataset(
     dataset: Optional[focd.Dataset] = None,
@@ -45,7 +178,10 @@ def update_dataset(
             将不会被添加到数据集中.
             若为True,更新将根据样本文件来,样本文件由参数 ``sample_path_list``来确定,
             遍历样本文件,其中和数据集中记录不一样的或者没有的将被更新进数据集
-            若 ``sample_path_list`` 没指定,那么样本文件列表为数据集所在文件夹的样本文件.
+            若 ``sample_path_list`` 没指定,那么样本文件列表为数据集所在文件夹的样本文件,
+            此时数据集中所有样本都会检查xml,而新样本只从上次更新(``dataset.info["last_update_ns"]``)
+            之后放入文件夹的文件中寻找.为了容忍文件系统和本机的时钟偏差,记录的时间会比扫描开始时间
+            提前10分钟(``_SCAN_SAFETY_MARGIN_NS``),多扫到的文件会和数据集中已有的样本去重.
 
         sample_path_list (Optional[List[str]]):
             若为None,将从待更新的数据集所在文件夹的样本文件开始遍历,否则将根据提供的样本文件列表开始遍历
@@ -58,14 +194,17 @@ def update_dataset(
             return
         else:
             dataset = s.dataset
-    update_img_path_list = []
     if update_imgs_asbase:
+        scan_start_ns = None
         if sample_path_list:
             imgs_path = sample_path_list
+            imgs_set = set(imgs_path)
         else:
             dataset_dir = dataset.info.get(
                 "dataset_dir", os.path.split(dataset.first().filepath)[0]
             )
+            # 只扫描上次更新之后放进文件夹的文件来找新样本,已有样本全部检查xml
+            scan_start_ns = time.time_ns()
             imgs_path = get_all_file_path(
                 dataset_dir,
                 filter_=(
@@ -78,61 +217,25 @@ def update_dataset(
                     ".jpeg",
                     ".JPEG",
                 ),
+                since_ns=dataset.info.get("last_update_ns", 0),
+            )
+            imgs_set = None
+        filepaths, xml_infos, stat_infos = _collect_xml_changes(dataset, imgs_set)
+        update_img_path_list = _apply_xml_changes(dataset, xml_infos, stat_infos)
+
+        exist_imgs = set(filepaths)
+        new_imgs_path = sorted(set(imgs_path) - exist_imgs)
+        if new_imgs_path:
+            new_samples = (generate_sgcc_sample(p) for p in new_imgs_path)
+            dataset.add_samples(s for s in new_samples if s is not None)
+        if scan_start_ns is not None:
+            dataset.info["last_update_ns"] = max(
+                scan_start_ns - _SCAN_SAFETY_MARGIN_NS, 0
             )
-        with dataset.save_context() as context:
-            for img_path in tqdm(
-                imgs_path,
-                desc="数据集更新进度:",
-                dynamic_ncols=True,
-                colour="green",
-            ):
-                if img_path in dataset:
-                    sample = dataset[img_path]
-                    xml_path = os.path.splitext(sample.filepath)[0] + ".xml"
-                    if not os.path.exists(xml_path):
-                        sample.clear_field("ground_truth")
-                        continue
-                    xml_md5 = md5sum(xml_path)
-                    if sample.has_field("xml_md5"):
-                        if sample.get_field("xml_md5") != xml_md5:
-                            img_meta, label_info, anno_dict = parse_sample_info(
-                                sample.filepath
-                            )
-                            sample.update_fields(anno_dict)
-                            sample.update_fields(
-                                {
-                                    "metadata": img_meta,
-                                    "ground_truth": label_info,
-                                    "xml_md5": xml_md5,
-                                }
-                            )
-                            update_img_path_list.append(sample.filepath)
-                        context.save(sample)
-                else:
-                    dataset.add_sample(generate_sgcc_sample(img_path))
         dataset.save()
     else:
-        for sample in dataset.iter_samples(
-            progress=True, autosave=True, batch_size=0.2
-        ):
-            xml_path = os.path.splitext(sample.filepath)[0] + ".xml"
-            if not os.path.exists(xml_path):
-                sample.clear_field("ground_truth")
-                continue
-            xml_md5 = md5sum(xml_path)
-            if sample.has_field("xml_md5"):
-                if sample.get_field("xml_md5") != xml_md5:
-                    img_meta, label_info, anno_dict = parse_sample_info(sample.filepath)
-                    sample.update_fields(anno_dict)
-                    sample.update_fields(
-                        {
-                            "metadata": img_meta,
-                            "ground_truth": label_info,
-                            "xml_md5": xml_md5,
-                        }
-                    )
-
-                    update_img_path_list.append(sample.filepath)
+        _, xml_infos, stat_infos = _collect_xml_changes(dataset)
+        update_img_path_list = _apply_xml_changes(dataset, xml_infos, stat_infos)
 
     update_dataview = imgslist2dataview(update_img_path_list, dataset)
     update_dataview.tag_samples(str(datetime.now()) + "update")
@@ -174,15 +277,12 @@ def add_dataset_fields_by_txt(
         with open(fields_dict, "r") as fr:
             fields_dict = json.load(fr)
 
-    for sample in tqdm(
-        dataset.select_by("filepath", imgs_path).iter_samples(autosave=True),
-        total=len(imgs_path),
-        desc="字段更新进度:",
-        dynamic_ncols=True,
-        colour="green",
-    ):
+    # 每个字段一次批量写入,不再逐个样本保存
+    view = dataset.select_by("filepath", imgs_path)
+    sample_num = len(view)
+    if sample_num:
         for k, v in fields_dict.items():
-            sample.set_field(k, v)
+            view.set_values(k, [v] * sample_num)
 
     session = WEAK_CACHE.get("session", None)
     if session is not None:
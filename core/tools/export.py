@@ -4,74 +4,147 @@
 @Date: 2023-02-28 16:52:46
 @LastEditors: captainsama tuanzhangsama@outlook.com
 @LastEditTime: 2023-03-02 10:00:03
-@FilePath: /dataset_manager/core/tools/exporter.py
+@FilePath: /dataset_manager/core/tools/export.py
 @Description:
 """
-from typing import Optional
+from typing import Optional, Tuple, List
 
 import os
+import io
+import time
 import json
+import tarfile
+import queue
+import threading
+import collections
+import contextlib
 from concurrent import futures
 
 import fiftyone as fo
 import fiftyone.core.dataset as focd
 from tqdm import tqdm
 
-from core.utils import get_sample_field, md5sum, get_all_file_path
+from core.utils import md5sum, get_all_file_path, batch_xywh2xyxy
 from core.exporter.sgccgame_dataset_exporter import SGCCGameDatasetExporter
 from core.logging import logging
 
 from core.cache import WEAK_CACHE
 
 
-def _export_one_sample_anno(sample, save_dir):
-    result = {}
-    need_export_map = {
-        "data_source": "data_source",
-        "img_quality": "img_quality",
-        "additions": "additions",
-        "tags": "sample_tags",
-        "chiebot_ID": "ID",
-    }
-
-    for k, v in need_export_map.items():
-        vv = get_sample_field(sample, k)
-        if vv:
-            result[v] = vv
-
-    result["chiebot_sample_tags"] = get_sample_field(
-        sample, "chiebot_sample_tags", default=[]
+_QUEUE_END = object()
+_MAX_PENDING_ANNO = 96
+
+# (数据集中的字段, anno中的key),值为空的字段不导出
+_NEED_EXPORT = (
+    ("data_source", "data_source"),
+    ("img_quality", "img_quality"),
+    ("additions", "additions"),
+    ("tags", "sample_tags"),
+    ("chiebot_ID", "ID"),
+)
+
+# 每个目标在anno中的固定字段,导出时浅拷贝后再填入 name 和 bbox
+_DET_TEMPLATE = {
+    "pose": "Unspecified",
+    "truncated": 0,
+    "difficult": 0,
+    "mask": [],
+    "confidence": -1,
+    "quality": 10,
+}
+
+# 导出anno需要的字段,顺序和 ``_anno_record`` 中的解包顺序一致
+_ANNO_FIELDS = (
+    (
+        "metadata.height",
+        "metadata.width",
+        "metadata.num_channels",
+        "ground_truth.detections.label",
+        "ground_truth.detections.bounding_box",
     )
+    + tuple(src for src, _ in _NEED_EXPORT)
+    + ("chiebot_sample_tags",)
+)
+
+
+def _dataset_anno_values(dataset) -> Tuple[List[str], List[tuple]]:
+    """一次性从数据库中投影出导出anno需要的所有字段
+
+    Returns:
+        Tuple[List[str], List[tuple]]: 样本的 filepath 列表和与之对齐的字段值元组列表,
+            元组顺序同 ``_ANNO_FIELDS``,数据集中没有的字段值为None,bbox已转为xyxy
+    """
+    schema = dataset.get_field_schema()
+    exist_fields = [f for f in _ANNO_FIELDS if f.split(".")[0] in schema]
+    filepaths, *cols = dataset.values(["filepath"] + exist_fields)
+    cols = dict(zip(exist_fields, cols))
+    empty_col = [None] * len(filepaths)
+    if "ground_truth.detections.bounding_box" in cols:
+        cols["ground_truth.detections.bounding_box"] = batch_xywh2xyxy(
+            cols["ground_truth.detections.bounding_box"]
+        )
+    return filepaths, list(zip(*(cols.get(f, empty_col) for f in _ANNO_FIELDS)))
+
 
-    result["img_shape"] = (
-        sample["metadata"].height,
-        sample["metadata"].width,
-        sample["metadata"].num_channels,
+def _sample_anno_values(sample) -> tuple:
+    """单个样本版本的 ``_dataset_anno_values``,只取一次样本的底层dict"""
+    d = sample.to_mongo_dict()
+    metadata = d.get("metadata") or {}
+    dets = (d.get("ground_truth") or {}).get("detections")
+    return (
+        metadata.get("height"),
+        metadata.get("width"),
+        metadata.get("num_channels"),
+        [det.get("label") for det in dets] if dets is not None else None,
+        batch_xywh2xyxy([[det["bounding_box"] for det in dets]])[0]
+        if dets is not None
+        else None,
+    ) + tuple(d.get(f) for f in _ANNO_FIELDS[5:])
+
+
+def _anno_record(values: tuple) -> dict:
+    height, width, num_channels, labels, bboxes = values[:5]
+    chiebot_sample_tags = values[-1]
+    result = {}
+    for (_, k), v in zip(_NEED_EXPORT, values[5:-1]):
+        if v:
+            result[k] = v
+
+    result["chiebot_sample_tags"] = (
+        chiebot_sample_tags if chiebot_sample_tags is not None else []
     )
+
+    result["img_shape"] = (height, width, num_channels)
     result["objs_info"] = []
-    dets = get_sample_field(sample, "ground_truth")
-    if dets:
-        for det in dets.detections:
-            obj = {}
-            obj["name"] = det.label
-            obj["pose"] = "Unspecified"
-            obj["truncated"] = 0
-            obj["difficult"] = 0
-            obj["mask"] = []
-            obj["confidence"] = -1
-            obj["quality"] = 10
-            obj["bbox"] = (
-                det.bounding_box[0],
-                det.bounding_box[1],
-                det.bounding_box[0] + det.bounding_box[2],
-                det.bounding_box[1] + det.bounding_box[3],
-            )
+    if labels:
+        for label, bbox in zip(labels, bboxes):
+            # 模板中的 mask 列表被所有目标共享,记录只做序列化,不会被修改
+            obj = _DET_TEMPLATE.copy()
+            obj["name"] = label
+            obj["bbox"] = bbox
 
             result["objs_info"].append(obj)
 
-    save_path = os.path.join(save_dir, os.path.splitext(sample.filename)[0] + ".anno")
-    with open(save_path, "w") as fw:
-        json.dump(result, fw, indent=4, sort_keys=True)
+    return result
+
+
+def _anno_save_paths(save_dir: str, filepaths: List[str]) -> List[str]:
+    """一次性计算所有样本对应的anno保存路径"""
+    _join, _splitext, _basename = os.path.join, os.path.splitext, os.path.basename
+    return [_join(save_dir, _splitext(_basename(p))[0] + ".anno") for p in filepaths]
+
+
+def _dump_anno(values: tuple) -> bytes:
+    """进程池的工作函数,只接收可pickle的字段值元组,不接触fiftyone对象"""
+    return json.dumps(_anno_record(values), separators=(",", ":")).encode("utf-8")
+
+
+def _write_anno(values_and_path) -> str:
+    """进程池的工作函数,接收 (values, save_path) 并写出anno文件"""
+    values, save_path = values_and_path
+    data = _dump_anno(values)
+    with open(save_path, "wb") as fw:
+        fw.write(data)
 
     return save_path
 
@@ -79,12 +152,15 @@ def _export_one_sample_anno(sample, save_dir):
 def export_anno_file(
     save_dir: str,
     dataset: Optional[focd.Dataset] = None,
+    archive: bool = False,
 ):
     """导出数据集的anno文件到 save_dir
 
     Args:
         save_dir (str): 保存anno的目录
         dataset (focd.Dataset,optional): 需要导出的数据集,若没有就用全局的数据集
+        archive (bool, optional): 若为True,所有anno顺序写入 ``save_dir/annos.tar`` 一个文件,
+            而不是生成大量小文件. Defaults to False.
     """
     if dataset is None:
         s = WEAK_CACHE.get("session", None)
@@ -93,25 +169,46 @@ def export_anno_file(
             return
         else:
             dataset = s.dataset
-    if not os.path.exists(save_dir):
-        os.mkdir(save_dir)
-    with futures.ThreadPoolExecutor(48) as exec:
-        tasks = [
-            exec.submit(_export_one_sample_anno, sample, save_dir) for sample in dataset
-        ]
-        for task in tqdm(
-            futures.as_completed(tasks),
-            total=len(dataset),
-            desc="anno导出进度:",
-            dynamic_ncols=True,
-            colour="green",
-        ):
-            save_path = task.result()
+    os.makedirs(save_dir, exist_ok=True)
+
+    filepaths, values = _dataset_anno_values(dataset)
+    save_paths = _anno_save_paths(save_dir, filepaths)
+    cpu_num = os.cpu_count() or 1
+    chunksize = max(1, len(values) // (cpu_num * 4))
+    pbar_cfg = dict(
+        total=len(values),
+        desc="anno导出进度:",
+        dynamic_ncols=True,
+        colour="green",
+    )
+    with futures.ProcessPoolExecutor(max_workers=cpu_num) as exec:
+        if archive:
+            # 子进程只负责序列化,主线程按顺序把结果流式写入tar
+            mtime = time.time()
+            with tarfile.open(
+                os.path.join(save_dir, "annos.tar"), "w|", bufsize=1 << 20
+            ) as tf:
+                for save_path, data in tqdm(
+                    zip(save_paths, exec.map(_dump_anno, values, chunksize=chunksize)),
+                    **pbar_cfg,
+                ):
+                    info = tarfile.TarInfo(os.path.basename(save_path))
+                    info.size = len(data)
+                    info.mtime = mtime
+                    tf.addfile(info, io.BytesIO(data))
+        else:
+            for _ in tqdm(
+                exec.map(
+                    _write_anno, zip(values, save_paths), chunksize=chunksize
+                ),
+                **pbar_cfg,
+            ):
+                pass
 
     print("anno 导出完毕")
 
 
-def _export_one_sample(sample, exporter, get_anno, save_dir):
+def _export_one_sample(sample, exporter):
     image_path = sample.filepath
 
     metadata = sample.metadata
@@ -123,8 +220,32 @@ def _export_one_sample(sample, exporter, get_anno, save_dir):
 
     exporter.export_sample(image_path, label, metadata=metadata)
 
-    if get_anno:
-        _export_one_sample_anno(sample, save_dir)
+
+def _warm_up_worker():
+    """空任务,用于提前拉起进程池的子进程"""
+    pass
+
+
+def _export_samples_media(
+    dataset, exporter, get_anno, save_dir, anno_queue, stop_event
+):
+    """在单独的io线程里按顺序导出媒体文件,并把anno需要的数据放入队列
+
+    队列中放入 (values, save_path),不导出anno时放入None,结束时放入 ``_QUEUE_END``.
+    ``stop_event`` 被设置后停止导出.
+    """
+    try:
+        for sample in dataset:
+            if stop_event.is_set():
+                break
+            _export_one_sample(sample, exporter)
+            if get_anno:
+                save_path = _anno_save_paths(save_dir, [sample.filepath])[0]
+                anno_queue.put((_sample_anno_values(sample), save_path))
+            else:
+                anno_queue.put(None)
+    finally:
+        anno_queue.put(_QUEUE_END)
 
 
 def export_sample(
@@ -145,25 +266,68 @@ def export_sample(
             return
         else:
             dataset = s.dataset
-    if not os.path.exists(save_dir):
-        os.mkdir(save_dir)
+    os.makedirs(save_dir, exist_ok=True)
     if "export_dir" in kwargs:
         kwargs.pop("export_dir")
     exporter = SGCCGameDatasetExporter(export_dir=save_dir, **kwargs)
+    anno_queue = queue.Queue(maxsize=256)
+    stop_event = threading.Event()
     with exporter:
         exporter.log_collection(dataset)
-        with futures.ThreadPoolExecutor(48) as exec:
-            tasks = [
-                exec.submit(_export_one_sample, sample, exporter, get_anno, save_dir)
-                for sample in dataset
-            ]
-            for task in tqdm(
-                futures.as_completed(tasks),
-                total=len(dataset),
-                desc="样本导出进度:",
-                dynamic_ncols=True,
-                colour="green",
-            ):
-                result = task.result()
-    print("样本导出完毕")
+        # exporter 内部的写入是串行的,只用一个io线程驱动,anno 的序列化交给多进程
+        anno_exec_ctx = (
+            futures.ProcessPoolExecutor(os.cpu_count())
+            if get_anno
+            else contextlib.nullcontext()
+        )
+        with anno_exec_ctx as anno_exec:
+            if anno_exec is not None:
+                # 在启动io线程之前先把子进程拉起来,避免在有其他线程运行时fork
+                anno_exec.submit(_warm_up_worker).result()
+            with futures.ThreadPoolExecutor(1) as io_exec:
+                producer = io_exec.submit(
+                    _export_samples_media,
+                    dataset,
+                    exporter,
+                    get_anno,
+                    save_dir,
+                    anno_queue,
+                    stop_event,
+                )
+                # 只保留有限个未完成的anno任务,内存占用不随数据集大小增长
+                anno_tasks = collections.deque()
+                queue_closed = False
+                try:
+                    with tqdm(
+                        total=len(dataset),
+                        desc="样本导出进度:",
+                        dynamic_ncols=True,
+                        colour="green",
+                    ) as pbar:
+                        while True:
+                            item = anno_queue.get()
+                            if item is _QUEUE_END:
+                                queue_closed = True
+                                break
+                            if item is not None:
+                                if len(anno_tasks) >= _MAX_PENDING_ANNO:
+                                    anno_tasks.popleft().result()
+                                anno_tasks.append(anno_exec.submit(_write_anno, item))
+                            pbar.update(1)
+                except BaseException:
+                    # 主线程出错时通知io线程停止,并继续取空队列,
+                    # 否则io线程会阻塞在 put 上,退出线程池时永远等不到它
+                    stop_event.set()
+                    for task in anno_tasks:
+                        task.cancel()
+                    if not queue_closed:
+                        while anno_queue.get() is not _QUEUE_END:
+                            pass
+                    raise
 
+                producer.result()
+                # 结果本身用不到,按提交顺序取结果只是为了抛出子进程中的异常
+                for task in anno_tasks:
+                    if not task.cancelled():
+                        task.result()
+    print("样本导出完毕")
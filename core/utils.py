@@ -1,5 +1,5 @@
 import hashlib
-from typing import Tuple
+from typing import Tuple, List, Optional
 import time
 from contextlib import contextmanager
 import os
@@ -8,16 +8,47 @@ import xml.etree.ElementTree as ET
 import fiftyone.core.metadata as fom
 from PIL import Image
 import numpy as np
+import xxhash
 from core.logging import logging
 
 
+def _scan_files(file_dir: str, filter_, since_ns: int):
+    try:
+        it = os.scandir(file_dir)
+    except OSError:
+        # 和 os.walk 一样忽略无法访问的目录
+        return
+    with it:
+        for entry in it:
+            # DirEntry 缓存了文件类型,不用再对每个文件 stat
+            if entry.is_dir():
+                # 和 os.walk 一样不进入指向目录的软链接
+                if not entry.is_symlink():
+                    yield from _scan_files(entry.path, filter_, since_ns)
+            elif os.path.splitext(entry.name)[1] in filter_:
+                if since_ns:
+                    try:
+                        if entry.stat().st_ctime_ns <= since_ns:
+                            continue
+                    except OSError:
+                        # 失效的软链接
+                        continue
+                yield entry.path
+
+
 def get_all_file_path(file_dir: str, filter_=
-                      (".jpg", ".JPG", ".png", ".PNG", ".bmp", ".BMP", ".jpeg",".JPEG")) -> list:
-    #遍历文件夹下所有的file
+                      (".jpg", ".JPG", ".png", ".PNG", ".bmp", ".BMP", ".jpeg",".JPEG"),
+                      since_ns: int = 0) -> list:
+    """遍历文件夹下所有的file,或者读取txt中记录的文件路径
+
+    Args:
+        file_dir (str): 文件夹或者记录了文件路径的txt
+        filter_ (tuple): 需要的文件后缀
+        since_ns (int): 仅对文件夹有效,非0时只返回 ctime 晚于该时间戳(ns)的文件.
+            使用 ctime 而不是 mtime,这样保留了 mtime 的拷贝(cp -p,rsync)也能被发现
+    """
     if os.path.isdir(file_dir):
-        return [os.path.join(maindir,filename) for maindir,_,file_name_list in os.walk(file_dir) \
-            for filename in file_name_list \
-            if os.path.splitext(filename)[1] in filter_ ]
+        return list(_scan_files(file_dir, filter_, since_ns))
     elif os.path.isfile(file_dir):
         with open(file_dir, 'r') as fr:
             paths = [os.path.abspath(x.strip()) for x in fr.readlines() if os.path.splitext(x.strip())[1] in filter_]
@@ -146,6 +177,32 @@ def normalization_xyxy(
 
     return (xmin/w,ymin/h,(xmax-xmin)/w,(ymax-ymin)/h),flag
 
+def batch_xywh2xyxy(bboxes_list: List[Optional[list]]) -> List[Optional[list]]:
+    """将多个样本的 tlx,tly,w,h 一次性转化成 xmin,ymin,xmax,ymax
+
+    Args:
+        bboxes_list (List[Optional[list]]): 每个样本的bbox列表,没有标签的样本为None
+
+    Returns:
+        List[Optional[list]]: 与输入对齐的 xyxy bbox 列表
+    """
+    flat = [bbox for bboxes in bboxes_list if bboxes for bbox in bboxes]
+    if not flat:
+        return bboxes_list
+    xyxy = np.asarray(flat, dtype=np.float64)
+    xyxy[:, 2:] += xyxy[:, :2]
+    xyxy = xyxy.tolist()
+
+    result = []
+    start = 0
+    for bboxes in bboxes_list:
+        if bboxes is None:
+            result.append(None)
+            continue
+        result.append(xyxy[start:start + len(bboxes)])
+        start += len(bboxes)
+    return result
+
 @contextmanager
 def timeblock(label:str = '\033[1;34mSpend time:\033[0m'):
     r'''上下文管理测试代码块运行时间,需要
@@ -170,6 +227,18 @@ def md5sum(count_str:str) -> str:
     return m.hexdigest()
 
 
+def xxhash_sum(count_str:str) -> str:
+    """xxh3_128 版本的 ``md5sum``,用于校验文件是否变化,非密码学用途"""
+    h = xxhash.xxh3_128()
+    if os.path.isfile(count_str):
+        with open(count_str,'rb') as frb:
+            for chunk in iter(lambda: frb.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        h.update(count_str.encode('utf-8'))
+    return h.hexdigest()
+
+
 def get_sample_field(sample,field,default=None):
     if sample.has_field(field):
         return sample.get_field(field)